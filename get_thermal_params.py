@@ -125,11 +125,13 @@ def get_thermal_params(image_path: str) -> dict:
     sdk = load_sdk()
     
     # 读取图像数据
+    rjpeg_size = os.path.getsize(image_path)
+    rjpeg_data = bytearray(rjpeg_size)
     with open(image_path, 'rb') as f:
-        rjpeg_data = f.read()
+        f.readinto(rjpeg_data)
     
-    rjpeg_size = len(rjpeg_data)
-    rjpeg_buffer = (c_uint8 * rjpeg_size).from_buffer_copy(rjpeg_data)
+    # from_buffer 直接引用 bytearray 内存, 无需复制
+    rjpeg_buffer = (c_uint8 * rjpeg_size).from_buffer(rjpeg_data)
     
     # 创建句柄
     handle = c_void_p()
@@ -4,19 +4,21 @@
 
 import os
 import sys
-import shutil
 import platform
-import subprocess
+import struct
+import mmap
 import ctypes
-from ctypes import c_int32, c_uint8, c_float, c_void_p, POINTER, Structure, byref
+from ctypes import c_int16, c_int32, c_uint8, c_float, c_void_p, POINTER, Structure, byref
 import piexif
 import numpy as np
 from tqdm import tqdm
 from PIL import Image
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
 import multiprocessing
-import threading
 import argparse
+from contextlib import contextmanager, suppress
 from dataclasses import dataclass
 from typing import Optional
 
@@ -49,14 +51,14 @@ class ProcessConfig:
     """处理配置"""
     input_dir: str                          # 输入文件夹路径
     output_dir: str                         # 输出文件夹路径
-    max_workers: int = 10                   # 最大线程数
+    max_workers: int = min(os.cpu_count() or 1, 61)  # 最大进程数 (Windows 上限为 61)
     use_image_params: bool = True           # 是否自动读取图像参数
     manual_params: Optional[ThermalParams] = None  # 手动指定的参数
+    preserve_gps: bool = True               # 是否在输出TIFF中保留GPS信息
 
 # ==================== SDK DLL 相关 ====================
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 SDK_DLL_DIR = os.path.join(SCRIPT_DIR, "dji_thermal_sdk_v1.8_20250829", "tsdk-core", "lib", "windows", "release_x64")
-SDK_EXE_PATH = os.path.join(SCRIPT_DIR, "dji_thermal_sdk_v1.8_20250829", "utility", "bin", "windows", "release_x64", "dji_irp.exe")
 
 class DirpMeasurementParams(Structure):
     """SDK测量参数结构体"""
@@ -68,141 +70,269 @@ class DirpMeasurementParams(Structure):
         ("ambient_temp", c_float),
     ]
 
-_sdk_lock = threading.Lock()
+class DirpResolution(Structure):
+    """SDK图像分辨率结构体"""
+    _fields_ = [
+        ("width", c_int32),
+        ("height", c_int32),
+    ]
+
 _sdk_instance = None
 
+# 每个工作进程内复用的缓冲区: 同型号相机分辨率一致, 避免逐张图像重复分配
+_raw_buffers = {}                        # (宽, 高) -> c_int16 数组
+_temp_buffers = {}                       # (高, 宽) -> float32 温度数组
+_sdk_params = DirpMeasurementParams()
+_read_buffer = bytearray()               # 按已读最大文件大小增长
+MMAP_THRESHOLD = 4 * 1024 * 1024         # 超过该大小的文件改用内存映射读取
+_manual_sdk_params = None                # 手动模式下预先构建的SDK参数
+
 def get_sdk():
-    """获取SDK实例（单例，线程安全）"""
+    """获取SDK实例（每个进程一个单例）"""
     global _sdk_instance
     if _sdk_instance is None:
-        with _sdk_lock:
-            if _sdk_instance is None:
-                if hasattr(os, 'add_dll_directory'):
-                    os.add_dll_directory(SDK_DLL_DIR)
-                os.environ['PATH'] = SDK_DLL_DIR + os.pathsep + os.environ.get('PATH', '')
-                
-                dll_path = os.path.join(SDK_DLL_DIR, "libdirp.dll")
-                if not os.path.exists(dll_path):
-                    raise FileNotFoundError(f"SDK DLL 未找到: {dll_path}")
-                
-                sdk = ctypes.CDLL(dll_path)
-                sdk.dirp_create_from_rjpeg.argtypes = [POINTER(c_uint8), c_int32, POINTER(c_void_p)]
-                sdk.dirp_create_from_rjpeg.restype = c_int32
-                sdk.dirp_destroy.argtypes = [c_void_p]
-                sdk.dirp_destroy.restype = c_int32
-                sdk.dirp_get_measurement_params.argtypes = [c_void_p, POINTER(DirpMeasurementParams)]
-                sdk.dirp_get_measurement_params.restype = c_int32
-                _sdk_instance = sdk
+        if hasattr(os, 'add_dll_directory'):
+            os.add_dll_directory(SDK_DLL_DIR)
+        os.environ['PATH'] = SDK_DLL_DIR + os.pathsep + os.environ.get('PATH', '')
+        
+        dll_path = os.path.join(SDK_DLL_DIR, "libdirp.dll")
+        if not os.path.exists(dll_path):
+            raise FileNotFoundError(f"SDK DLL 未找到: {dll_path}")
+        
+        sdk = ctypes.CDLL(dll_path)
+        sdk.dirp_create_from_rjpeg.argtypes = [POINTER(c_uint8), c_int32, POINTER(c_void_p)]
+        sdk.dirp_create_from_rjpeg.restype = c_int32
+        sdk.dirp_destroy.argtypes = [c_void_p]
+        sdk.dirp_destroy.restype = c_int32
+        sdk.dirp_get_measurement_params.argtypes = [c_void_p, POINTER(DirpMeasurementParams)]
+        sdk.dirp_get_measurement_params.restype = c_int32
+        sdk.dirp_set_measurement_params.argtypes = [c_void_p, POINTER(DirpMeasurementParams)]
+        sdk.dirp_set_measurement_params.restype = c_int32
+        sdk.dirp_get_rjpeg_resolution.argtypes = [c_void_p, POINTER(DirpResolution)]
+        sdk.dirp_get_rjpeg_resolution.restype = c_int32
+        sdk.dirp_measure.argtypes = [c_void_p, POINTER(c_int16), c_int32]
+        sdk.dirp_measure.restype = c_int32
+        _sdk_instance = sdk
     return _sdk_instance
 
-def read_params_from_image(image_path: str) -> ThermalParams:
-    """从图像中读取嵌入的测量参数"""
-    sdk = get_sdk()
+def _worker_init(manual_params: Optional[ThermalParams] = None):
+    """工作进程初始化: 预先加载SDK, 避免首张图像承担DLL加载开销; 手动模式下一次性构建SDK参数"""
+    global _manual_sdk_params
+    get_sdk()
+    if manual_params is not None:
+        _manual_sdk_params = to_sdk_params(manual_params)
+
+@contextmanager
+def open_rjpeg(image_path: str):
+    """读取R-JPEG文件数据, 以可写 memoryview 形式提供, 退出时释放
     
+    小文件读入进程内复用的 bytearray (下一次读取会覆盖其内容);
+    大文件使用写时复制的内存映射, 避免多进程并发时占用大量临时内存
+    """
+    global _read_buffer
+    mm = None
     with open(image_path, 'rb') as f:
-        data = f.read()
+        size = os.fstat(f.fileno()).st_size
+        if size > MMAP_THRESHOLD:
+            # ctypes 的 from_buffer 要求可写缓冲区, 只读映射 (ACCESS_READ) 不可用
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            data = memoryview(mm)
+        else:
+            if size > len(_read_buffer):
+                # 旧缓冲区可能仍被引用而无法扩容, 直接换新的
+                _read_buffer = bytearray(size)
+            size = f.readinto(_read_buffer)
+            data = memoryview(_read_buffer)[:size]
     
-    buf = (c_uint8 * len(data)).from_buffer_copy(data)
+    try:
+        yield data
+    except BaseException:
+        # 已有异常在传播时, 若仍有视图引用数据导致释放失败, 交由垃圾回收处理, 不掩盖原异常
+        with suppress(BufferError):
+            data.release()
+        if mm is not None:
+            with suppress(BufferError):
+                mm.close()
+        raise
+    data.release()
+    if mm is not None:
+        mm.close()
+
+def create_handle(sdk, data):
+    """由R-JPEG文件数据创建DIRP句柄, 数据需在句柄销毁前保持有效"""
+    # from_buffer 直接引用已读入的内存, 避免再复制一份
+    buf = (c_uint8 * len(data)).from_buffer(data)
     handle = c_void_p()
     ret = sdk.dirp_create_from_rjpeg(buf, len(data), byref(handle))
+    # 立即释放 ctypes 视图: 否则抛出异常时回溯会持有它, 导致内存映射无法关闭
+    del buf
     if ret != 0:
         raise RuntimeError(f"创建DIRP句柄失败, 错误码: {ret}")
+    return handle
+
+def extract_exif(data) -> Optional[bytes]:
+    """从内存中的JPEG数据提取 APP1 Exif 段的TIFF数据, 仅复制该段, 不存在时返回 None"""
+    if data[:2] != b"\xff\xd8":
+        return None
     
-    try:
-        params = DirpMeasurementParams()
-        ret = sdk.dirp_get_measurement_params(handle, byref(params))
-        if ret != 0:
-            raise RuntimeError(f"获取测量参数失败, 错误码: {ret}")
-        
-        return ThermalParams(
-            emissivity=params.emissivity,
-            distance=params.distance,
-            humidity=params.humidity,
-            reflection=params.reflection,
-            ambient=params.ambient_temp,
-        )
-    finally:
-        sdk.dirp_destroy(handle)
+    head = 2
+    while head + 4 <= len(data):
+        marker, length = struct.unpack_from(">HH", data, head)
+        if marker == 0xFFDA or marker >> 8 != 0xFF:  # 到达图像数据 (SOS), 元数据段已结束
+            break
+        if marker == 0xFFE1 and data[head + 4:head + 10] == b"Exif\x00\x00":
+            return bytes(data[head + 10:head + 2 + length])
+        head += 2 + length
+    return None
+
+def get_params_from_handle(sdk, handle) -> ThermalParams:
+    """从DIRP句柄读取测量参数"""
+    params = _sdk_params
+    ret = sdk.dirp_get_measurement_params(handle, byref(params))
+    if ret != 0:
+        raise RuntimeError(f"获取测量参数失败, 错误码: {ret}")
+    
+    return ThermalParams(
+        emissivity=params.emissivity,
+        distance=params.distance,
+        humidity=params.humidity,
+        reflection=params.reflection,
+        ambient=params.ambient_temp,
+    )
+
+def to_sdk_params(params: ThermalParams) -> DirpMeasurementParams:
+    """将测量参数转换为SDK结构体"""
+    return DirpMeasurementParams(
+        distance=params.distance,
+        humidity=params.humidity,
+        emissivity=params.emissivity,
+        reflection=params.reflection,
+        ambient_temp=params.ambient,
+    )
+
+def set_params_to_handle(sdk, handle, sdk_params: DirpMeasurementParams):
+    """将SDK测量参数写入DIRP句柄"""
+    ret = sdk.dirp_set_measurement_params(handle, byref(sdk_params))
+    if ret != 0:
+        raise RuntimeError(f"设置测量参数失败, 错误码: {ret}")
+
+def read_params_from_image(image_path: str) -> ThermalParams:
+    """从图像中读取嵌入的测量参数"""
+    sdk = get_sdk()
+    with open_rjpeg(image_path) as rjpeg_data:
+        handle = create_handle(sdk, rjpeg_data)
+        try:
+            return get_params_from_handle(sdk, handle)
+        finally:
+            sdk.dirp_destroy(handle)
 
 # ==================== 核心处理函数 ====================
+IMAGE_EXTENSIONS = frozenset(('.jpg', '.jpeg', '.png'))
+
 def get_platform():
     return platform.system()
 
-def mkdir(path):
-    if os.path.exists(path):
-        shutil.rmtree(path)
-    os.makedirs(path)
-    return True
+def scan_images(input_dir: str) -> list:
+    """递归扫描目录下的图像文件 (os.scandir 复用目录项信息, 避免额外 stat)
+    
+    结果按文件大小降序排列, 大文件先处理, 避免耗时任务拖到最后造成尾部等待
+    """
+    image_files = []
+    stack = [input_dir]
+    while stack:
+        # 与 os.walk 一致: 无法读取或已消失的目录直接跳过
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                    image_files.append((entry.stat().st_size, entry.path))
+    image_files.sort(key=lambda item: item[0], reverse=True)
+    return [path for _, path in image_files]
+
+def get_resolution_from_handle(sdk, handle):
+    """从DIRP句柄读取图像分辨率, 返回 (宽, 高)"""
+    resolution = DirpResolution()
+    ret = sdk.dirp_get_rjpeg_resolution(handle, byref(resolution))
+    if ret != 0:
+        raise RuntimeError(f"获取图像分辨率失败, 错误码: {ret}")
+    return resolution.width, resolution.height
 
-def convert_to_raw(input_path: str, output_path: str, params: ThermalParams):
-    """调用SDK将R-JPEG转换为RAW温度数据"""
-    # 转换为绝对路径
-    input_abs = os.path.abspath(input_path)
-    output_abs = os.path.abspath(output_path)
-    exe_abs = os.path.abspath(SDK_EXE_PATH)
-    
-    # 构建命令参数列表
-    cmd_args = [
-        exe_abs,
-        "-s", input_abs,
-        "-a", "measure",
-        "-o", output_abs,
-        "--emissivity", str(params.emissivity),
-        "--distance", str(params.distance),
-        "--humidity", str(params.humidity),
-        "--reflection", str(params.reflection),
-        "--ambient", str(params.ambient),
-    ]
+def measure_temperature(sdk, handle, width: int, height: int):
+    """在进程内调用SDK计算温度, 返回 int16 数组 (实际温度的10倍)
     
-    # 执行命令并等待完成
-    result = subprocess.run(cmd_args, capture_output=True, text=True)
+    返回的数组引用进程内复用的缓冲区, 仅在下一次测量前有效
+    """
+    raw = _raw_buffers.get((width, height))
+    if raw is None:
+        raw = _raw_buffers[(width, height)] = (c_int16 * (width * height))()
+    ret = sdk.dirp_measure(handle, raw, ctypes.sizeof(raw))
+    if ret != 0:
+        raise RuntimeError(f"SDK温度测量失败, 错误码: {ret}")
     
-    # 检查输出文件是否生成
-    if not os.path.exists(output_abs):
-        raise RuntimeError(f"SDK转换失败: {result.stderr or result.stdout or '未知错误'}")
+    return np.frombuffer(raw, dtype=np.int16).reshape(height, width)
+
+def scale_temperature(raw):
+    """将RAW值 (实际温度的10倍) 转换为 float32 摄氏度, 结果写入进程内复用的缓冲区"""
+    out = _temp_buffers.get(raw.shape)
+    if out is None:
+        out = _temp_buffers[raw.shape] = np.empty(raw.shape, dtype=np.float32)
+    return np.divide(raw, np.float32(10.0), out=out)
 
-def process_single_image(input_path: str, temp_dir: str, output_dir: str, 
-                         use_image_params: bool, manual_params: Optional[ThermalParams]):
+def process_single_image(input_path: str, output_dir: str,
+                         use_image_params: bool, manual_params: Optional[ThermalParams],
+                         preserve_gps: bool = True):
     """处理单张图片"""
     try:
         img_name = os.path.basename(input_path)
         base_name = os.path.splitext(img_name)[0]
-        thread_id = threading.get_ident()
         
-        raw_path = os.path.join(temp_dir, f"{base_name}_{thread_id}.raw")
         tiff_path = os.path.join(output_dir, f"{base_name}.tiff")
         
-        # 获取参数
-        if use_image_params:
-            params = read_params_from_image(input_path)
-        else:
-            params = manual_params
-        
-        # 转换为RAW
-        convert_to_raw(input_path, raw_path, params)
-        
-        # 读取图像尺寸
-        image = Image.open(input_path)
-        width, height = image.size
+        sdk = get_sdk()
+        with open_rjpeg(input_path) as rjpeg_data:
+            # 复用已读入内存的文件数据提取EXIF段 (仅复制该段), 不再重新打开文件
+            exif_data = extract_exif(rjpeg_data) if preserve_gps else None
+            
+            # 创建句柄 (每张图像只解析一次, 后续全部复用该句柄)
+            handle = create_handle(sdk, rjpeg_data)
+            try:
+                # 读取分辨率 (代替 Image.open 获取尺寸)
+                width, height = get_resolution_from_handle(sdk, handle)
+                
+                # 获取参数
+                if use_image_params:
+                    params = get_params_from_handle(sdk, handle)
+                else:
+                    params = manual_params
+                    sdk_params = _manual_sdk_params
+                    if sdk_params is None:
+                        sdk_params = to_sdk_params(manual_params)
+                    set_params_to_handle(sdk, handle, sdk_params)
+                
+                # 计算温度
+                img_data = measure_temperature(sdk, handle, width, height)
+            finally:
+                sdk.dirp_destroy(handle)
         
-        # 读取RAW数据并转换
-        img_data = np.fromfile(raw_path, dtype='int16')
-        img_data = img_data / 10.0  # RAW值是实际温度的10倍
-        img_data = img_data.reshape(height, width)
+        img_data = scale_temperature(img_data)
         
-        # 保存为TIFF
+        # 保存为TIFF (仅保留GPS; PIL 的 TIFF 写入不会输出缩略图, 无需携带)
         im = Image.fromarray(img_data)
-        exif_dict = piexif.load(input_path)
-        new_exif = {
-            '0th': {}, 'Exif': {}, 'GPS': exif_dict.get('GPS', {}),
-            'Interop': {}, '1st': {}, 'thumbnail': exif_dict.get('thumbnail', None)
-        }
-        exif_bytes = piexif.dump(new_exif)
-        im.save(tiff_path, exif=exif_bytes)
-        
-        # 清理临时文件
-        if os.path.exists(raw_path):
-            os.remove(raw_path)
+        if preserve_gps:
+            exif_dict = piexif.load(exif_data) if exif_data else {}
+            new_exif = {
+                '0th': {}, 'Exif': {}, 'GPS': exif_dict.get('GPS', {}),
+                'Interop': {}, '1st': {}, 'thumbnail': None
+            }
+            exif_bytes = piexif.dump(new_exif)
+            im.save(tiff_path, exif=exif_bytes)
+        else:
+            im.save(tiff_path)
         
         return True, input_path, params
     except Exception as e:
@@ -214,17 +344,14 @@ def run(config: ProcessConfig):
     print("DJI Thermal SDK v1.8 热成像批量转换工具")
     print("=" * 60)
     
-    # 创建目录
-    temp_dir = "temp_dir"
-    mkdir(temp_dir)
-    mkdir(config.output_dir)
+    # 预先加载SDK, DLL 缺失等问题在启动时直接报错, 而不是在工作进程中失败
+    get_sdk()
+    
+    # 创建输出目录 (已存在时保留原有文件, 同名输出会被覆盖)
+    os.makedirs(config.output_dir, exist_ok=True)
     
     # 获取文件列表
-    input_files = []
-    for root, _, files in os.walk(config.input_dir):
-        for f in files:
-            if f.lower().endswith(('.jpg', '.jpeg', '.png')):
-                input_files.append(os.path.join(root, f))
+    input_files = scan_images(config.input_dir)
     
     if not input_files:
         raise ValueError(f"在 {config.input_dir} 中未找到图像文件")
@@ -232,7 +359,7 @@ def run(config: ProcessConfig):
     print(f"\n输入目录: {config.input_dir}")
     print(f"输出目录: {config.output_dir}")
     print(f"检测到文件: {len(input_files)} 个")
-    print(f"线程数: {config.max_workers}")
+    print(f"进程数: {config.max_workers}")
     
     if config.use_image_params:
         print(f"参数模式: 自动读取图像嵌入参数")
@@ -248,29 +375,37 @@ def run(config: ProcessConfig):
     
     print("\n开始处理...")
     
-    # 多线程处理
+    # 多进程处理 (每个工作进程持有独立的SDK实例)
+    # 按批次分发任务, 每批只需一次进程间通信, 减少逐张图像的调度开销
     success_count = 0
     failed_files = []
+    chunksize = max(1, len(input_files) // (config.max_workers * 8))
     
-    with ThreadPoolExecutor(max_workers=config.max_workers) as executor:
-        futures = {
-            executor.submit(
-                process_single_image, f, temp_dir, config.output_dir,
-                config.use_image_params, config.manual_params
-            ): f for f in input_files
-        }
+    manual_params = None if config.use_image_params else config.manual_params
+    with ProcessPoolExecutor(max_workers=config.max_workers, initializer=_worker_init,
+                             initargs=(manual_params,)) as executor:
+        results = executor.map(
+            process_single_image, input_files, repeat(config.output_dir),
+            repeat(config.use_image_params), repeat(config.manual_params),
+            repeat(config.preserve_gps), chunksize=chunksize,
+        )
         
-        with tqdm(total=len(input_files), desc="转换进度") as pbar:
-            for future in as_completed(futures):
-                success, result, _ = future.result()
-                if success:
-                    success_count += 1
-                else:
-                    failed_files.append(result)
-                pbar.update(1)
-    
-    # 清理
-    shutil.rmtree(temp_dir)
+        # 降低进度条刷新频率, 避免终端输出占用主进程时间
+        done_count = 0
+        with tqdm(total=len(input_files), desc="转换进度", mininterval=0.5) as pbar:
+            try:
+                for success, result, _ in results:
+                    if success:
+                        success_count += 1
+                    else:
+                        failed_files.append(result)
+                    done_count += 1
+                    pbar.update(1)
+            except BrokenProcessPool:
+                # 工作进程异常退出 (如SDK崩溃), 剩余图像无法得到结果
+                unfinished = input_files[done_count:]
+                tqdm.write(f"工作进程异常退出, {len(unfinished)} 个文件未完成处理")
+                failed_files.extend(f"{f}: 工作进程异常退出, 未完成处理" for f in unfinished)
     
     # 结果统计
     print(f"\n处理完成: {success_count}/{len(input_files)} 成功")
@@ -313,13 +448,16 @@ if __name__ == "__main__":
     # ==================== 基础配置 ====================
     INPUT_DIR = "input_dir"       # 输入文件夹路径
     OUTPUT_DIR = "out_dir"        # 输出文件夹路径
-    MAX_WORKERS = 10              # 并行处理线程数
+    MAX_WORKERS = min(os.cpu_count() or 1, 61)  # 并行处理进程数 (Windows 上限为 61)
     
     # ==================== 模式选择 ====================
     # False = 自动模式: 从每张图像自动读取嵌入的参数
     # True  = 手动模式: 使用下面手动指定的统一参数
     USE_MANUAL_PARAMS = False
     
+    # ==================== 输出选项 ====================
+    PRESERVE_GPS = True           # 是否在输出TIFF中保留原始GPS信息
+    
     # ==================== 手动模式参数 ====================
     # 仅当 USE_MANUAL_PARAMS = True 时生效
     MANUAL_EMISSIVITY = 0.95      # 发射率 [0.10, 1.00]
@@ -336,6 +474,7 @@ if __name__ == "__main__":
             output_dir=OUTPUT_DIR,
             max_workers=MAX_WORKERS,
             use_image_params=False,
+            preserve_gps=PRESERVE_GPS,
             manual_params=ThermalParams(
                 emissivity=MANUAL_EMISSIVITY,
                 distance=MANUAL_DISTANCE,
@@ -352,6 +491,7 @@ if __name__ == "__main__":
             max_workers=MAX_WORKERS,
             use_image_params=True,
             manual_params=None,
+            preserve_gps=PRESERVE_GPS,
         )
     
     # 执行处理